@@ -37,19 +37,30 @@ EYEBALL_MIN_PERC = 1
 # transit networks
 HEGE_MIN = 0.01
 
+import hashlib
+import json
+import multiprocessing
 import os
-from collections import defaultdict
+import queue
+import sys
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from IPython.display import display, HTML
 from plotly.graph_objs import *
 import plotly.express as px
+import plotly.io as pio
+import numpy as np
 import pandas as pd
 from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.sparse import csr_matrix
+from scipy.spatial.distance import squareform
+from sklearn.metrics.pairwise import cosine_similarity
 
 
 #init_notebook_mode(connected=True) 
 
 # Setup access to IYP
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, READ_ACCESS
 
 # Prepare output folders
 os.makedirs('output', exist_ok=True)
@@ -58,73 +69,183 @@ os.makedirs('output/as_peering_count', exist_ok=True)
 os.makedirs('output/ixp_stats', exist_ok=True)
 os.makedirs('output/box', exist_ok=True)
 
+# Per-country figures are rendered to HTML in background processes, leaving
+# half of the cores for queries and pandas. Workers must be forked, other start
+# methods re-run this script in each worker, and fork is not safe on macOS.
+# Elsewhere figures are written directly.
+# The first task starts all forked workers, do it now, before the database
+# driver and query threads exist.
+html_writer = None
+if sys.platform != 'darwin' and 'fork' in multiprocessing.get_all_start_methods():
+    html_writer = ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 2)//2),
+                                      mp_context=multiprocessing.get_context('fork'))
+    html_writer.submit(int).result()
+html_writes = []
+
+def write_html(fig, fname):
+    if html_writer is None:
+        fig.write_html(fname)
+    else:
+        html_writes.append(html_writer.submit(pio.write_html, fig.to_dict(), fname))
+
+# Query results are cached in this folder, delete it to force fetching data
+# from IYP again
+CACHE_DIR = 'cache'
+os.makedirs(CACHE_DIR, exist_ok=True)
+
 # Using IYP local instance
 URI = "neo4j://localhost:7687"
 # Using IYP public instance
 # URI = "neo4j://iyp-bolt.iijlab.net:7687"
 AUTH = ('neo4j', 'password')
-db = GraphDatabase.driver(URI, auth=AUTH)
+DATABASE = 'neo4j'
+# Number of per-country queries sent concurrently to the database
+MAX_CONCURRENT_QUERIES = 16
+db = GraphDatabase.driver(URI, auth=AUTH, max_connection_pool_size=2*MAX_CONCURRENT_QUERIES)
+
+# %% [markdown]
+# ## One-time setup: index query anchors
+# All queries start from a country code. Set CREATE_INDEXES to True to index
+# it, this requires write access (not available on the IYP public instance).
+
+# %%
+CREATE_INDEXES = False
+
+def plan_operators(plan):
+    operators = [plan['operatorType']]
+    for child in plan.get('children', []):
+        operators += plan_operators(child)
+    return operators
+
+if CREATE_INDEXES:
+    db.execute_query("CREATE INDEX country_code IF NOT EXISTS FOR (c:Country) ON (c.country_code)",
+                     database_=DATABASE)
+    db.execute_query("CALL db.awaitIndexes()", database_=DATABASE)
+
+    # Check that the planner now starts from the index instead of scanning
+    # all Country nodes
+    summary = db.execute_query("EXPLAIN MATCH (c:Country {country_code:$country_code}) RETURN c",
+                               country_code=COUNTRY_CODES[0], database_=DATABASE).summary
+    operators = plan_operators(summary.plan)
+    if any('IndexSeek' in op for op in operators):
+        print('Country.country_code index is used')
+    else:
+        print(f'WARNING: Country.country_code index not used, query plan: {operators}')
 
+# %%
 query_dt = """
 MATCH (:Country {country_code:$country_code})-[p:POPULATION]-(:Estimate) RETURN p.reference_time_fetch
 """
-res, _, _ = db.execute_query(query_dt, country_code=COUNTRY_CODES[0])
-if len(res):
-    print(f"Data collected on {res[0][0]}")
 
-def group_by_nb_ix(query):
-    country_df = {}
-    as_nb_ix_list = []
+# Parameters shared by all queries
+QUERY_PARAMS = {'eyeball_min_perc': EYEBALL_MIN_PERC, 'hege_min': HEGE_MIN}
+
+def read_session():
+    return db.session(database=DATABASE, default_access_mode=READ_ACCESS)
+
+def read_df(tx, query, params):
+    # Build the DataFrame directly from the result stream
+    return tx.run(query, params).to_df()
+
+with read_session() as session:
+    df = session.execute_read(read_df, query_dt, {'country_code': COUNTRY_CODES[0]})
+data_time = ''
+if len(df):
+    data_time = str(df.iloc[0, 0])
+    print(f"Data collected on {data_time}")
+else:
+    print("WARNING: unknown data collection time, query results will not be cached")
+
+def cached_query(query, session=None, **params) -> pd.DataFrame:
+    """Run the query and return results as a DataFrame. Results are cached on
+    disk and reused as long as the query, parameters, IYP instance, and IYP data
+    are the same. The cache is not used if the IYP data time is unknown.
+    A new session is opened if none is given."""
+    fname = None
+    if data_time:
+        key = json.dumps([query, params, URI, DATABASE, data_time], sort_keys=True)
+        fname = os.path.join(CACHE_DIR, hashlib.sha256(key.encode()).hexdigest() + '.parquet')
+        if os.path.exists(fname):
+            return pd.read_parquet(fname)
+
+    if session is None:
+        with read_session() as session:
+            return cached_query(query, session, **params)
+
+    df = session.execute_read(read_df, query, params)
+    if fname is None:
+        return df
+
+    # Write to a temporary file first to never leave a partial cache entry
+    df.to_parquet(fname + '.tmp', compression='zstd')
+    os.replace(fname + '.tmp', fname)
 
-    for country_code in COUNTRY_CODES:
-        res, _, keys = db.execute_query(query, country_code=country_code, 
-                                        eyeball_min_perc=EYEBALL_MIN_PERC, hege_min=HEGE_MIN)
-        df = pd.DataFrame(res, columns=keys)
+    return df
 
-        # Keep data for later analysis
-        country_df[country_code] = df
+def query_per_country(query, **params):
+    """Run the query for each country in COUNTRY_CODES concurrently and yield
+    (country_code, DataFrame) in the order of COUNTRY_CODES."""
+
+    # Sessions are not thread-safe, each running query takes one from the pool
+    # and gives it back when done
+    sessions = queue.SimpleQueue()
+    for _ in range(MAX_CONCURRENT_QUERIES):
+        sessions.put(read_session())
+
+    def country_query(country_code):
+        session = sessions.get()
+        try:
+            return cached_query(query, session, country_code=country_code, **params)
+        finally:
+            sessions.put(session)
+
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_QUERIES) as executor:
+            # Submit queries only as results are consumed, so that results of
+            # all countries are never held in memory at once
+            pending = deque()
+            for country_code in COUNTRY_CODES:
+                pending.append((country_code, executor.submit(country_query, country_code)))
+                if len(pending) > MAX_CONCURRENT_QUERIES:
+                    done_country_code, future = pending.popleft()
+                    yield done_country_code, future.result()
+
+            while pending:
+                done_country_code, future = pending.popleft()
+                yield done_country_code, future.result()
+    finally:
+        while not sessions.empty():
+            sessions.get().close()
 
-        # Compute percentage of AS per number of IXP 
-        gb = df.groupby('nb_ix').count()/len(df)
-        gb['country'] = country_code
+def group_by_nb_ix(query):
+    df = cached_query(query, country_codes=COUNTRY_CODES, **QUERY_PARAMS)
 
-        as_nb_ix_list.append(gb)
+    # Compute percentage of AS per number of IXP for each country
+    totals = df.groupby('country').size()
+    counts = df.groupby(['country', 'nb_ix']).size()
+    df = counts.div(totals, level='country').reset_index(name='asn')
 
-    df = pd.concat(as_nb_ix_list)
-    df['nb_ix'] = df.index
-
-    return df
+    # Keep countries in the same order as COUNTRY_CODES
+    country_rank = {country_code: i for i, country_code in enumerate(COUNTRY_CODES)}
+    return df.sort_values('country', key=lambda c: c.map(country_rank), kind='stable')
 
 
 def as_no_ixp(query) -> pd.DataFrame:
-    country_df = {}
-    as_nb_ix_list = []
-
-    for country_code in COUNTRY_CODES:
-        res, _, keys = db.execute_query(query, country_code=country_code,
-                                        eyeball_min_perc=EYEBALL_MIN_PERC, hege_min=HEGE_MIN)
-        df = pd.DataFrame(res, columns=keys)
-        df = df[df['nb_ix'] == 0]
-
-        # Keep data for later analysis
-        df['country'] = country_code
-        country_df[country_code] = df
-        as_nb_ix_list.append(df)
+    df = cached_query(query, country_codes=COUNTRY_CODES, **QUERY_PARAMS)
 
-    df = pd.concat(as_nb_ix_list)
-
-    return df
+    return df[df['nb_ix'] == 0]
 
 
 # Find ASes registered in the country and the IXPs they are member of
 query_all = """
-MATCH (ases:AS)-[:COUNTRY {reference_org:'NRO'}]-(:Country {country_code:$country_code})
+UNWIND $country_codes AS country_code
+MATCH (ases:AS)-[:COUNTRY {reference_org:'NRO'}]-(:Country {country_code:country_code})
 WHERE (ases)-[:ORIGINATE]-(:Prefix)
 OPTIONAL MATCH (ases)-[:MEMBER_OF]-(ix:IXP)
 OPTIONAL MATCH (ases)-[:RANK {reference_name:'caida.asrank'}]-(ix:IXP)
 OPTIONAL MATCH (ix)-[:COUNTRY]-(cc:Country)
 OPTIONAL MATCH (ases)-[:NAME {reference_org:'RIPE NCC'}]-(as_name:Name)
-RETURN $country_code AS country, ases.asn AS asn, as_name.name AS as_name, count(DISTINCT ix) AS nb_ix,
+RETURN country_code AS country, ases.asn AS asn, as_name.name AS as_name, count(DISTINCT ix) AS nb_ix,
 collect(DISTINCT cc.country_code) AS ix_country, collect(DISTINCT ix.name) AS ix_name
 """
 df = group_by_nb_ix(query_all)
@@ -135,49 +256,52 @@ fig = px.bar(df, x='country', y="asn", color='nb_ix',
 fig.write_html('output/as_peering_count/all.html')
 
 query_top = """
-MATCH (ases:AS)-[:COUNTRY {reference_org:'NRO'}]-(:Country {country_code:$country_code})
+UNWIND $country_codes AS country_code
+MATCH (ases:AS)-[:COUNTRY {reference_org:'NRO'}]-(:Country {country_code:country_code})
 MATCH (ases)-[ihr_rank:RANK {reference_org:'IHR', weightscheme:'as'}]-(:Ranking)
 WHERE (ases)-[:ORIGINATE]-(:Prefix) AND ihr_rank.hege > $hege_min
 OPTIONAL MATCH (ases)-[:MEMBER_OF]-(ix:IXP)
 OPTIONAL MATCH (ases)-[:RANK {reference_name:'caida.asrank'}]-(ix:IXP)
 OPTIONAL MATCH (ix)-[:COUNTRY]-(cc:Country)
 OPTIONAL MATCH (ases)-[:NAME {reference_org:'RIPE NCC'}]-(as_name:Name)
-RETURN $country_code AS country, ases.asn AS asn, as_name.name AS as_name, count(DISTINCT ix) AS nb_ix,
+RETURN country_code AS country, ases.asn AS asn, as_name.name AS as_name, count(DISTINCT ix) AS nb_ix,
 collect(DISTINCT cc.country_code) AS ix_country, collect(DISTINCT ix.name) AS ix_name
 """
 df = group_by_nb_ix(query_top)
 fig = px.bar(df, x='country', y="asn", color='nb_ix',
              color_continuous_scale=[(0.00, "red"),   (0.01, "red"), (0.01, "green"),
                                      (0.66, "green"), (0.66, "blue"),  (1.00, "blue")],
-             title='Distribution of transit networks at IXPs (transit for more that 1% ASes)', text='nb_ix')
+             title=f'Distribution of transit networks at IXPs (transit for more than {HEGE_MIN*100:g}% ASes)', text='nb_ix')
 fig.write_html('output/as_peering_count/transit.html')
 
 query_pop = """
-MATCH (ases:AS)-[:COUNTRY {reference_org:'NRO'}]-(selected_country:Country {country_code:$country_code})
+UNWIND $country_codes AS country_code
+MATCH (ases:AS)-[:COUNTRY {reference_org:'NRO'}]-(selected_country:Country {country_code:country_code})
 MATCH (ases)-[p:POPULATION]-(selected_country)
 WHERE (ases)-[:ORIGINATE]-(:Prefix) AND p.percent > $eyeball_min_perc
 OPTIONAL MATCH (ases)-[:MEMBER_OF]-(ix:IXP)
 OPTIONAL MATCH (ases)-[:RANK {reference_name:'caida.asrank'}]-(ix:IXP)
 OPTIONAL MATCH (ix)-[:COUNTRY]-(cc:Country)
 OPTIONAL MATCH (ases)-[:NAME {reference_org:'RIPE NCC'}]-(as_name:Name)
-RETURN $country_code AS country, ases.asn AS asn, as_name.name AS as_name, count(DISTINCT ix) AS nb_ix,
+RETURN country_code AS country, ases.asn AS asn, as_name.name AS as_name, count(DISTINCT ix) AS nb_ix,
 collect(DISTINCT cc.country_code) AS ix_country, collect(DISTINCT ix.name) AS ix_name
 """
 df = group_by_nb_ix(query_pop)
 fig = px.bar(df, x='country', y="asn", color='nb_ix',
              color_continuous_scale=[(0.00, "red"),   (0.01, "red"), (0.01, "green"),
                                      (0.66, "green"), (0.66, "blue"),  (1.00, "blue")],
-             title='Distribution of eyeball networks at IXPs (host more than 1% population)', text='nb_ix')
+             title=f'Distribution of eyeball networks at IXPs (host more than {EYEBALL_MIN_PERC}% population)', text='nb_ix')
 fig.write_html('output/as_peering_count/eyeball.html')
 
 # %% [markdown]
 # ## Eyeball networks not at IXPs
 
 # %%
+no_ixp_html = as_no_ixp(query_pop).to_html()
 with open('output/no_ixp.html', 'w') as fp:
-    as_no_ixp(query_pop).to_html(fp)
+    fp.write(no_ixp_html)
 
-display(HTML(as_no_ixp(query_pop).to_html()))
+display(HTML(no_ixp_html))
 # %%
 
 # %% [markdown]
@@ -204,26 +328,25 @@ WHERE other_country.country_code <> $country_code
 RETURN  member.asn AS asn, coalesce(tag.label, 'Other') AS label, count(DISTINCT lower(ix_dom.name)) AS nb_dom_ix, count(DISTINCT lower(ix_intl.name)) AS nb_intl_ix
 """
 
-for country_code in COUNTRY_CODES:
-    res, _, keys = db.execute_query(query_as_membership, country_code=country_code)
-    df = pd.DataFrame(res, columns=keys)
-
+for country_code, df in query_per_country(query_as_membership):
     fig = px.box(df, x='label', y='nb_dom_ix')
-    fig.write_html(f'output/box/{country_code}_dom.html')
+    write_html(fig, f'output/box/{country_code}_dom.html')
     fig = px.box(df, x='label', y='nb_intl_ix')
-    fig.write_html(f'output/box/{country_code}_intl.html')
+    write_html(fig, f'output/box/{country_code}_intl.html')
+
 
+# Column of each ASN in the IXP membership matrices, shared by all countries
+# and filled as new ASNs are found
+asn_index = {}
 
 def heatmap_ixps(query, fname_suffix):
-    for country_code in COUNTRY_CODES:
+    for country_code, df in query_per_country(query, **QUERY_PARAMS):
         ixs = defaultdict(set)
         countries = defaultdict(set)
         asns = set()
         membership_per_dataset = defaultdict(set)
-        res, _, _ = db.execute_query(query, country_code=country_code,
-                                     hege_min=HEGE_MIN, eyeball_min_perc=EYEBALL_MIN_PERC)
-        for ix_name, member_asn, ix_country, data_source in res:
-            ixs[ix_name.lower()].add(member_asn)
+        for ix_name, member_asn, ix_country, data_source in df.itertuples(index=False):
+            ixs[ix_name].add(member_asn)
             asns.add(member_asn)
             countries[ix_country].add(member_asn)
 
@@ -242,37 +365,38 @@ def heatmap_ixps(query, fname_suffix):
         for ix in to_remove:
             ixs.pop(ix)
 
-        # Build the matrix
-        nb_members_matrix = []
-        for members0 in ixs.values():
-            row = []
-            for members1 in ixs.values():
-                row.append(len(members0.intersection(members1)))
-                if NORMALIZE:
-                    row[-1] /= len(members0)
+        # Build the sparse IXP x ASN membership matrix, the number of common
+        # members between two IXPs is then given by a single matrix product
+        rows, cols = [], []
+        for i, members in enumerate(ixs.values()):
+            rows.extend([i]*len(members))
+            cols.extend(asn_index.setdefault(asn, len(asn_index)) for asn in members)
+        membership = csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                                shape=(len(ixs), len(asn_index)))
 
-            nb_members_matrix.append(row)
+        nb_members_matrix = (membership @ membership.T).toarray().astype(np.int32)
+        if NORMALIZE:
+            nb_members_matrix = nb_members_matrix / nb_members_matrix.diagonal()[:, None]
 
         if len(nb_members_matrix) > 0:
             labels = list(ixs.keys())
 
             if len(nb_members_matrix) > 1:
-                # Sort the matrix / Cluster the data
+                # Sort the matrix / Cluster the data, IXPs are compared by the
+                # cosine distance of their members so that large IXPs are not
+                # grouped only because of their size
                 threshold_cluster = 0.2
-                Z = linkage(nb_members_matrix, 'ward')
-                clusters = list(fcluster(Z, threshold_cluster, criterion='distance'))
+                distance = np.clip(1 - cosine_similarity(membership), 0, None)
+                Z = linkage(squareform(distance, checks=False), 'average')
+                clusters = fcluster(Z, threshold_cluster, criterion='distance')
 
                 # clusterer = AgglomerativeClustering(n_clusters=len(nb_members_matrix), metric="precomputed", linkage="average")
                 # clusters = list(clusterer.fit_predict(nb_members_matrix))
-                sorted_labels = []
-                sorted_matrix = []
-                for i in range(max(clusters)):
-                    idx = clusters.index(i+1)
-                    sorted_labels.append(labels[idx])
 
-                    row = nb_members_matrix[idx]
-                    sorted_row = [row[clusters.index(j+1)] for j in range(max(clusters))]
-                    sorted_matrix.append(sorted_row)
+                # Group IXPs of the same cluster together
+                perm = np.argsort(clusters, kind='stable')
+                sorted_labels = [labels[idx] for idx in perm]
+                sorted_matrix = nb_members_matrix[perm][:, perm]
 
             else:
                 sorted_labels = labels
@@ -289,7 +413,7 @@ def heatmap_ixps(query, fname_suffix):
 
             fig = px.imshow(sorted_matrix, x=sorted_labels, y=sorted_labels,
                             color_continuous_scale='sunsetdark', title=title, text_auto=True)
-            fig.write_html(f'output/ixp_distribution/{country_code}_{fname_suffix}.html')
+            write_html(fig, f'output/ixp_distribution/{country_code}_{fname_suffix}.html')
         else:
             print(f'WARNING: ({fname_suffix}) no data for {country_code}')
             print(to_remove)
@@ -300,11 +424,10 @@ MATCH (members:AS)-[:COUNTRY {reference_org:'NRO'}]-(:Country {country_code:$cou
 WHERE (members)-[:ORIGINATE]-(:Prefix)
 MATCH (ix)-[mo:MEMBER_OF]-(members)
 OPTIONAL MATCH (ix:IXP)-[:COUNTRY]-(ix_country:Country)
-OPTIONAL MATCH (ix:IXP)-[:MANAGED_BY {reference_org:'PeeringDB'}]-(ix_org:Organization)
-RETURN  ix.name + ' - ' + upper(coalesce(ix_country.country_code, 'zz')) AS ix_name,
+RETURN DISTINCT toLower(ix.name + ' - ' + coalesce(ix_country.country_code, 'zz')) AS ix_name,
 members.asn AS member_asn, ix_country.country_code AS ix_country,
 mo.reference_org AS data_source
-ORDER BY ix_name, ix_org.name
+ORDER BY ix_name
 """
 
 heatmap_ixps(query_ix_mem_all, 'all')
@@ -317,11 +440,10 @@ if True:
     WHERE ihr_rank.hege > $hege_min
     MATCH (ix)-[mo:MEMBER_OF]-(members)
     OPTIONAL MATCH (ix:IXP)-[:COUNTRY]-(ix_country:Country)
-    OPTIONAL MATCH (ix:IXP)-[:MANAGED_BY {reference_org:'PeeringDB'}]-(ix_org:Organization)
-    RETURN  ix.name + ' - ' + upper(coalesce(ix_country.country_code, 'zz')) AS ix_name,
+    RETURN DISTINCT toLower(ix.name + ' - ' + coalesce(ix_country.country_code, 'zz')) AS ix_name,
     members.asn AS member_asn, ix_country.country_code AS ix_country,
     mo.reference_org AS data_source
-    ORDER BY ix_name, ix_org.name
+    ORDER BY ix_name
     """
 
 #    query_ix_mem_transit = """
@@ -346,11 +468,10 @@ if True:
     MATCH (members)-[p:POPULATION]-(selected_country)
     WHERE  p.percent > $eyeball_min_perc
     OPTIONAL MATCH (ix:IXP)-[:COUNTRY]-(ix_country:Country)
-    OPTIONAL MATCH (ix:IXP)-[:MANAGED_BY {reference_org:'PeeringDB'}]-(ix_org:Organization)
-    RETURN  ix.name + ' - ' + upper(coalesce(ix_country.country_code, 'zz')) AS ix_name,
+    RETURN DISTINCT toLower(ix.name + ' - ' + coalesce(ix_country.country_code, 'zz')) AS ix_name,
     members.asn AS member_asn, ix_country.country_code AS ix_country,
     mo.reference_org AS data_source
-    ORDER BY ix_name, ix_org.name
+    ORDER BY ix_name
     """
 
 #    MATCH (members:AS)-[:COUNTRY {reference_org:'NRO'}]-(:Country {country_code:$country_code})
@@ -373,11 +494,10 @@ if True:
     MATCH (members)-[:CATEGORIZED]-(:Tag {label:'Content'})
     MATCH (ix)-[mo:MEMBER_OF]-(members)
     OPTIONAL MATCH (ix:IXP)-[:COUNTRY]-(ix_country:Country)
-    OPTIONAL MATCH (ix:IXP)-[:MANAGED_BY {reference_org:'PeeringDB'}]-(ix_org:Organization)
-    RETURN  ix.name + ' - ' + upper(coalesce(ix_country.country_code, 'zz')) AS ix_name,
+    RETURN DISTINCT toLower(ix.name + ' - ' + coalesce(ix_country.country_code, 'zz')) AS ix_name,
     members.asn AS member_asn, ix_country.country_code AS ix_country,
     mo.reference_org AS data_source
-    ORDER BY ix_name, ix_org.name
+    ORDER BY ix_name
     """
 
     heatmap_ixps(query_ix_mem_content, 'content')
@@ -386,11 +506,10 @@ if True:
     MATCH (members:AS)-[mo:MEMBER_OF]-(ix:IXP)-[:COUNTRY]-(ix_country:Country {country_code:$country_code})
     MATCH (members:AS)-[:COUNTRY {reference_org:'NRO'}]-(as_country:Country)
     WHERE  as_country.country_code <> $country_code AND (members)-[:ORIGINATE]-(:Prefix)
-    OPTIONAL MATCH (ix:IXP)-[:MANAGED_BY {reference_org:'PeeringDB'}]-(ix_org:Organization)
-    RETURN  ix.name + ' - ' + upper(coalesce(ix_country.country_code, 'zz')) AS ix_name,
+    RETURN DISTINCT toLower(ix.name + ' - ' + coalesce(ix_country.country_code, 'zz')) AS ix_name,
     members.asn AS member_asn, ix_country.country_code AS ix_country,
     mo.reference_org AS data_source
-    ORDER BY ix_name, ix_org.name
+    ORDER BY ix_name
     """
 
     heatmap_ixps(query_ix_mem_intl, 'intl')
@@ -406,12 +525,14 @@ count(DISTINCT eyeball_as) AS nb_eyeball, collect(DISTINCT content_as.asn) AS co
 collect(DISTINCT eyeball_as.asn) AS eyeball_ases, cc.country_code as country_code
 """
 
-for country_code in COUNTRY_CODES:
-    res, _, keys = db.execute_query(query_ix_stats, country_code=country_code)
-    df = pd.DataFrame(res, columns=keys)
-
+for country_code, df in query_per_country(query_ix_stats):
     if len(df):
         fig = px.scatter(df, x='nb_content', y='nb_eyeball', size='nb_members', hover_name='ix_name')
-        fig.write_html(f'output/ixp_stats/{country_code}.html')
+        write_html(fig, f'output/ixp_stats/{country_code}.html')
+
+# Wait for all figures to be written
+for future in html_writes:
+    future.result()
+html_writes.clear()
 
 